@@ -0,0 +1,162 @@
+""" In-memory response cache for the read-only endpoints """
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+
+# most responses kept at once; the keys come from user supplied query
+# params, so the cache has to be bounded
+RESPONSE_CACHE_MAXSIZE = 256
+
+# streamed bodies larger than this are sent without being cached, so a
+# large `limit` never holds more than one batch in memory
+STREAM_CACHE_MAX_BYTES = 256 * 1024
+
+# endpoint parameters that supply a database session rather than a filter
+_UNKEYED_PARAMS = ("db", "session_factory")
+
+# (endpoint name, query params) -> (expires_at, JSON body), least recently
+# used first
+_response_cache: OrderedDict[tuple, tuple[float, bytes]] = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+# function name -> (value, expires_at)
+_ttl_cache: dict[str, tuple[object, float]] = {}
+
+
+def cached_response(adapter: TypeAdapter, expire: int = 30):
+    """Cache the serialized JSON body of an endpoint for `expire` seconds.
+
+    The endpoint's ORM results are validated and dumped to JSON bytes with
+    `adapter` in one pass, and the returned `Response` skips FastAPI's own
+    response_model serialization. The cache key is the endpoint name plus
+    its query parameters; the database session passed in by
+    `Depends(get_db)` is left out of it. Cache hits return the stored bytes
+    without touching the database or building any Pydantic models.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(**kwargs):
+            key = _cache_key(func, kwargs)
+            body = _cached_body(key)
+            if body is not None:
+                return Response(content=body, media_type="application/json")
+
+            result = func(**kwargs)
+            body = adapter.dump_json(
+                adapter.validate_python(result, from_attributes=True))
+            _store_body(key, body, expire)
+            return Response(content=body, media_type="application/json")
+        return wrapper
+    return decorator
+
+
+def streamed_response(adapter: TypeAdapter, expire: int = 30):
+    """Stream an endpoint's results as a JSON array, caching small bodies.
+
+    The endpoint returns an iterator of lists of ORM rows (for example the
+    partitions of a `yield_per` result). Each list is dumped with the list
+    `adapter` and written out as soon as it's ready, so the first bytes go
+    out before the query finishes. Bodies up to STREAM_CACHE_MAX_BYTES are
+    kept and cached like `cached_response` once fully sent; past that the
+    copy is dropped and memory stays at one batch.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(**kwargs):
+            key = _cache_key(func, kwargs)
+            body = _cached_body(key)
+            if body is not None:
+                return Response(content=body, media_type="application/json")
+
+            def iter_json():
+                chunks = [b"["]
+                size = 1
+                first = True
+                yield b"["
+                for rows in func(**kwargs):
+                    # drop the list's own brackets so batches join into one array
+                    chunk = adapter.dump_json(
+                        adapter.validate_python(rows, from_attributes=True))[1:-1]
+                    if not chunk:
+                        continue
+                    if not first:
+                        chunk = b"," + chunk
+                    first = False
+                    if chunks is not None:
+                        size += len(chunk)
+                        if size > STREAM_CACHE_MAX_BYTES:
+                            chunks = None
+                        else:
+                            chunks.append(chunk)
+                    yield chunk
+                yield b"]"
+                if chunks is not None:
+                    chunks.append(b"]")
+                    _store_body(key, b"".join(chunks), expire)
+
+            return StreamingResponse(iter_json(), media_type="application/json")
+        return wrapper
+    return decorator
+
+
+def _cache_key(func, kwargs):
+    """The endpoint name plus its query parameters, minus the session"""
+    return (func.__name__,) + tuple(
+        sorted((k, v) for k, v in kwargs.items() if k not in _UNKEYED_PARAMS))
+
+
+def _cached_body(key):
+    """The cached body for `key`, or None if it's missing or expired"""
+    with _response_cache_lock:
+        hit = _response_cache.get(key)
+        if hit is None or hit[0] <= time.monotonic():
+            return None
+        _response_cache.move_to_end(key)
+        return hit[1]
+
+
+def _store_body(key, body: bytes, expire: int):
+    """Cache `body` under `key`, dropping expired and least recently used
+    entries to stay within RESPONSE_CACHE_MAXSIZE"""
+    now = time.monotonic()
+    with _response_cache_lock:
+        for stale in [k for k, (expires_at, _) in _response_cache.items()
+                      if expires_at <= now]:
+            del _response_cache[stale]
+        _response_cache[key] = (now + expire, body)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_MAXSIZE:
+            _response_cache.popitem(last=False)
+
+
+def ttl_cache(ttl_seconds: int):
+    """Memoize a function's result for `ttl_seconds`, keyed by function name.
+
+    Only meant for functions whose result doesn't depend on their
+    arguments, such as the table counts that just take a session.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            now = time.monotonic()
+            hit = _ttl_cache.get(func.__name__)
+            if hit is not None and hit[1] > now:
+                return hit[0]
+
+            value = func(*args, **kwargs)
+            _ttl_cache[func.__name__] = (value, now + ttl_seconds)
+            return value
+        return wrapper
+    return decorator
+
+
+def clear():
+    """Drop every cached response and memoized value"""
+    with _response_cache_lock:
+        _response_cache.clear()
+    _ttl_cache.clear()
@@ -0,0 +1,16 @@
+"""Shared pytest fixtures"""
+import pytest
+from sqlalchemy import event
+
+from database import engine
+
+
+@pytest.fixture(scope="function")
+def captured_statements():
+    """Collects the SQL statements sent to the database during a test"""
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", capture)
+    yield statements
+    event.remove(engine, "before_cursor_execute", capture)
@@ -1,90 +1,200 @@
 """ SQLAlchemy CRUD operations for FastAPI """
 
+from functools import lru_cache
+from itertools import chain
+
+from sqlalchemy import bindparam, func, select
 from sqlalchemy.orm import Session
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import raiseload, selectinload
 from datetime import date
 
 # mapping fo the models to the database
 import models
-
-# select top(1) * from player where player_id = {player_id}
+from cache import ttl_cache
+
+# how long the table counts are reused before hitting the database again
+COUNT_TTL_SECONDS = 300
+
+# rows fetched per round-trip when a list is streamed instead of returned
+STREAM_BATCH_SIZE = 200
+
+# loader options for the relationships each schema serializes; any other
+# relationship raises instead of being lazy loaded
+PLAYER_LOADER_OPTIONS = (
+    selectinload(models.Player.performances),
+    raiseload("*"))
+TEAM_LOADER_OPTIONS = (
+    selectinload(models.Team.players)
+    .selectinload(models.Player.performances),
+    raiseload("*"))
+LEAGUE_LOADER_OPTIONS = (
+    selectinload(models.League.teams)
+    .selectinload(models.Team.players)
+    .selectinload(models.Player.performances),
+    raiseload("*"))
+
+# primary key lookup: served from the session's identity map when the
+# player is already loaded, otherwise select * from player where player_id = ?
 def get_player(db: Session, player_id: int):
-    return db.query(models.Player).filter(models.Player.player_id == player_id).first()
+    return db.get(models.Player, player_id, options=PLAYER_LOADER_OPTIONS)
+
+
+# list queries use the loader options above, so a new relationship can't
+# sneak in an N+1. Each filter combination's statement is built once and cached, with the
+# filter values, skip and limit passed in as bind parameters.
+def _active_filters(**filters):
+    """The names of the filters that were given, as a cache key, and their values"""
+    active = {name: value for name, value in filters.items() if value}
+    return frozenset(active), active
+
+
+def _paged(stmt):
+    return stmt.offset(bindparam("skip")).limit(bindparam("limit"))
 
 
+@lru_cache
+def _players_stmt(filters: frozenset):
+    stmt = select(models.Player).options(*PLAYER_LOADER_OPTIONS)
+    if "min_last_changed_date" in filters:
+        stmt = stmt.where(models.Player.last_changed_date >= bindparam("min_last_changed_date"))
+    if "last_name" in filters:
+        stmt = stmt.where(models.Player.last_name == bindparam("last_name"))
+    if "first_name" in filters:
+        stmt = stmt.where(models.Player.first_name == bindparam("first_name"))
+    return _paged(stmt)
+
 # min_last_changed_date, multi query
 def get_players(db: Session,
-                skip: int = 0.,
+                skip: int = 0,
                 limit: int = 100,
                 min_last_changed_date: date = None,
                 last_name : str = None,
                 first_name : str = None,):
-    query = db.query(models.Player)
-    if min_last_changed_date:
-        query = query.filter(models.Player.last_changed_date >= min_last_changed_date)
-    if last_name:
-        query = query.filter(models.Player.last_name == last_name)
-    if first_name:
-        query = query.filter(models.Player.first_name == first_name)
-    return query.offset(skip).limit(limit).all()
+    return list(chain.from_iterable(iter_players(db,
+                                                 skip=skip,
+                                                 limit=limit,
+                                                 min_last_changed_date=min_last_changed_date,
+                                                 last_name=last_name,
+                                                 first_name=first_name)))
+
+# the same players in lists of STREAM_BATCH_SIZE, fetched a batch at a time
+def iter_players(db: Session,
+                 skip: int = 0,
+                 limit: int = 100,
+                 min_last_changed_date: date = None,
+                 last_name : str = None,
+                 first_name : str = None,):
+    filters, params = _active_filters(min_last_changed_date=min_last_changed_date,
+                                      last_name=last_name,
+                                      first_name=first_name)
+    return db.execute(_players_stmt(filters),
+                      {**params, "skip": skip, "limit": limit},
+                      execution_options={"yield_per": STREAM_BATCH_SIZE}).scalars().partitions()
 
 #get performance
+@lru_cache
+def _performances_stmt(filters: frozenset):
+    stmt = select(models.Performance).options(raiseload("*"))
+    if "min_last_changed_date" in filters:
+        stmt = stmt.where(models.Performance.last_changed_date >= bindparam("min_last_changed_date"))
+    return _paged(stmt)
+
 def get_performances(db: Session,
                     skip: int = 0,
                     limit: int = 100,
                     min_last_changed_date: date = None,):
-    query = db.query(models.Performance)
-    if min_last_changed_date:
-        query = query.filter(models.Performance.last_changed_date >= min_last_changed_date)
-    return query.offset(skip).limit(limit).all()
+    return list(chain.from_iterable(iter_performances(db,
+                                                      skip=skip,
+                                                      limit=limit,
+                                                      min_last_changed_date=min_last_changed_date)))
+
+# the same performances in lists of STREAM_BATCH_SIZE, fetched a batch at a time
+def iter_performances(db: Session,
+                      skip: int = 0,
+                      limit: int = 100,
+                      min_last_changed_date: date = None,):
+    filters, params = _active_filters(min_last_changed_date=min_last_changed_date)
+    return db.execute(_performances_stmt(filters),
+                      {**params, "skip": skip, "limit": limit},
+                      execution_options={"yield_per": STREAM_BATCH_SIZE}).scalars().partitions()
 
 #get league
 def get_league(db: Session,
                league_id: int = None):
-    return db.query(models.League).filter(models.League.league_id == league_id).first()
+    return db.get(models.League, league_id, options=LEAGUE_LOADER_OPTIONS)
 
 
 #get leagues
+@lru_cache
+def _leagues_stmt(filters: frozenset):
+    stmt = select(models.League).options(*LEAGUE_LOADER_OPTIONS)
+    if "min_last_changed_date" in filters:
+        stmt = stmt.where(models.League.last_changed_date >= bindparam("min_last_changed_date"))
+    if "league_name" in filters:
+        stmt = stmt.where(models.League.league_name == bindparam("league_name"))
+    return _paged(stmt)
+
 def get_leagues(db : Session,
                 skip : int = 0,
                 limit : int = 100,
                 min_last_changed_date : date = None,
-                league_name : int = None):
-    query = db.query(models.League).options(joinedload(models.League.teams))
-    if min_last_changed_date:
-        query = query.filter(models.League.last_changed_date >= min_last_changed_date)
-    if league_name:
-        query = query.filter(models.League.league_name == league_name)
-    return query.offset(skip).limit(limit).all()
+                league_name : str = None):
+    filters, params = _active_filters(min_last_changed_date=min_last_changed_date,
+                                      league_name=league_name)
+    # selectinload fetches each collection with a separate IN query, so the
+    # league rows come back once each and need no .unique(). A joinedload
+    # of a collection would repeat leagues per team and require .unique(),
+    # and filtering on a joined table would call for contains_eager().
+    return db.execute(_leagues_stmt(filters),
+                      {**params, "skip": skip, "limit": limit}).scalars().all()
 
 
 #get teams
+@lru_cache
+def _teams_stmt(filters: frozenset):
+    stmt = select(models.Team).options(*TEAM_LOADER_OPTIONS)
+    if "min_last_changed_date" in filters:
+        stmt = stmt.where(models.Team.last_changed_date >= bindparam("min_last_changed_date"))
+    if "team_name" in filters:
+        stmt = stmt.where(models.Team.team_name == bindparam("team_name"))
+    if "league_id" in filters:
+        stmt = stmt.where(models.Team.league_id == bindparam("league_id"))
+    return _paged(stmt)
+
 def get_teams(db: Session,
               skip : int = 0,
               limit : int = 100,
               min_last_changed_date : date = None,
               team_name : str = None,
               league_id : int = None):
-    query = db.query(models.Team)
-    if min_last_changed_date:
-        query = query.filter(models.Team.last_changed_date >= min_last_changed_date)
-    if team_name:
-        query = query.filter(models.Team.team_name == team_name)
-    if league_id:
-        query = query.filter(models.Team.league_id == league_id)
-    return query.offset(skip).limit(limit).all()
+    filters, params = _active_filters(min_last_changed_date=min_last_changed_date,
+                                      team_name=team_name,
+                                      league_id=league_id)
+    return db.execute(_teams_stmt(filters),
+                      {**params, "skip": skip, "limit": limit}).scalars().all()
 
 
 #get some analtical query
+# select count(*) avoids the subquery wrapper that Query.count() emits
+@ttl_cache(COUNT_TTL_SECONDS)
 def get_player_count(db: Session):
-    query = db.query(models.Player)
-    return query.count()
+    return db.execute(select(func.count()).select_from(models.Player)).scalar()
 
+@ttl_cache(COUNT_TTL_SECONDS)
 def get_team_count(db: Session):
-    query = db.query(models.Team)
-    return query.count()
+    return db.execute(select(func.count()).select_from(models.Team)).scalar()
 
+@ttl_cache(COUNT_TTL_SECONDS)
 def get_league_count(db: Session):
-    query = db.query(models.League)
-    return query.count()
-
+    return db.execute(select(func.count()).select_from(models.League)).scalar()
+
+# all three counts in one round-trip using scalar subqueries
+@ttl_cache(COUNT_TTL_SECONDS)
+def get_all_counts(db: Session):
+    stmt = select(
+        select(func.count()).select_from(models.League).scalar_subquery(),
+        select(func.count()).select_from(models.Team).scalar_subquery(),
+        select(func.count()).select_from(models.Player).scalar_subquery(),
+    )
+    league_count, team_count, player_count = db.execute(stmt).one()
+    return league_count, team_count, player_count
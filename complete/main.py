@@ -1,10 +1,29 @@
-from fastapi import Depends, FastAPI, HTTPException, Query
-from sqlalchemy.orm import Session
+import math
+import os
+import secrets
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Annotated
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from sqlalchemy import event
+from sqlalchemy.orm import Session, sessionmaker
 from datetime import date
 
+from loguru import logger
+
+import cache
 import crud
 import schemas
-from database import SessionLocal
+from database import ReadSession, engine, optimize_database
+
+# set DEBUG=1 to log requests that run more queries than expected: more
+# than QUERY_COUNT_THRESHOLD per STREAM_BATCH_SIZE rows the request asks for
+DEBUG = os.getenv("DEBUG") == "1"
+QUERY_COUNT_THRESHOLD = 5
+
+# set ADMIN_TOKEN to enable the admin routes for callers sending it in the
+# X-Admin-Token header; without it they always refuse
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 api_description = """ 
 This API provides read-only access to info from the SportsWorldCentral
@@ -27,21 +46,85 @@ they scored using SWC league scoring.
 Get information about all the SWC fantasy football leagues and the teams in them.
 """
 
+# run SQLite's planner maintenance each time the API starts
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    optimize_database()
+    yield
+
 #FastAPI constructor with additional details added for OpenAPI Specification
 app = FastAPI(
     description=api_description, 
     title="Sports World Central (SWC) Fantasy Footbal API", 
-    version="0.1" 
+    version="0.1",
+    lifespan=lifespan
 )
 
-# Dependency to get the database session
-def get_db():
-    db = SessionLocal()
+# Count the SQL statements each request runs so N+1 regressions show up in
+# development. The counter lives in a context variable, which FastAPI
+# copies into the threadpool that runs the sync endpoints.
+_query_counter: ContextVar[list[int] | None] = ContextVar("query_counter", default=None)
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+# eager loads run one selectin query per batch of rows, so a large limit
+# legitimately needs more queries; scale the threshold with it
+def query_count_threshold(request: Request):
+    try:
+        limit = int(request.query_params.get("limit", 0))
+    except ValueError:
+        limit = 0
+    batches = max(1, math.ceil(limit / crud.STREAM_BATCH_SIZE))
+    return QUERY_COUNT_THRESHOLD * batches
+
+if DEBUG:
+    event.listen(engine, "before_cursor_execute", count_query)
+
+    @app.middleware("http")
+    async def warn_on_query_count(request: Request, call_next):
+        counter = [0]
+        token = _query_counter.set(counter)
+        try:
+            response = await call_next(request)
+        finally:
+            _query_counter.reset(token)
+
+        # streamed bodies keep querying after call_next returns, so only
+        # check the count once the whole body has been sent
+        body_iterator = response.body_iterator
+        async def body_then_check():
+            async for chunk in body_iterator:
+                yield chunk
+            threshold = query_count_threshold(request)
+            if counter[0] > threshold:
+                logger.warning(f"{request.method} {request.url.path} ran "
+                               f"{counter[0]} queries (threshold {threshold})")
+        response.body_iterator = body_then_check()
+        return response
+
+# Dependency to get the read-only session factory. Every endpoint gets its
+# sessions from here, so override this one to point the API at another database
+def get_session_factory():
+    return ReadSession
+
+# Dependency to get a read-only database session
+def get_db(session_factory: Annotated[sessionmaker, Depends(get_session_factory)]):
+    db = session_factory()
     try:
         yield db
     finally:
         db.close()
 
+# Streamed endpoints open their own session from the factory: a
+# Depends(get_db) session is closed once the endpoint returns, before the
+# response body is sent
+def iter_with_db(session_factory: sessionmaker, iter_func, **kwargs):
+    with session_factory() as db:
+        yield from iter_func(db, **kwargs)
+
 @app.get("/", tags=["analytics"],
           summary="Get Analytics Overview",
           description="Fetch a general overview of analytics related to the system.",
@@ -55,19 +138,19 @@ async def root():
           description="Retrieve a list of all players from the database.",
           response_description="A list of player objects with player details.",
           operation_id="get_all_players")
-def read_players(skip: int = Query(0, description="The number of items toskip at the beginning of API call."),
-                limit: int = Query(100, description="The number of records to returnafter the skipped records."),
-                min_last_changed_date: date = Query(None, description="The minimum date of change that you want to return records. Exclude any records changed before this."),
-                first_name: str = Query(None, description="The first name of the playersto return"),
-                last_name: str = Query(None, description="The last name of the playersto return"),
-                db: Session = Depends(get_db)):
-    players = crud.get_players(db,
-                              skip=skip,
-                              limit=limit,
-                              min_last_changed_date=min_last_changed_date,
-                              last_name=last_name,
-                              first_name=first_name)
-    return players
+@cache.streamed_response(schemas.PLAYER_LIST_ADAPTER, expire=30)
+def read_players(session_factory: Annotated[sessionmaker, Depends(get_session_factory)],
+                skip: Annotated[int, Query(description="The number of items toskip at the beginning of API call.")] = 0,
+                limit: Annotated[int, Query(description="The number of records to returnafter the skipped records.")] = 100,
+                min_last_changed_date: Annotated[date | None, Query(description="The minimum date of change that you want to return records. Exclude any records changed before this.")] = None,
+                first_name: Annotated[str | None, Query(description="The first name of the playersto return")] = None,
+                last_name: Annotated[str | None, Query(description="The last name of the playersto return")] = None):
+    return iter_with_db(session_factory, crud.iter_players,
+                        skip=skip,
+                        limit=limit,
+                        min_last_changed_date=min_last_changed_date,
+                        last_name=last_name,
+                        first_name=first_name)
 
 
 
@@ -78,8 +161,9 @@ def read_players(skip: int = Query(0, description="The number of items toskip at
         response_description="One NFL player", 
         operation_id="v0_get_players_by_player_id", 
         tags=["player"])
+@cache.cached_response(schemas.PLAYER_ADAPTER, expire=30)
 def read_player(player_id: int,
-                db: Session = Depends(get_db)):
+                db: Annotated[Session, Depends(get_db)]):
     """
     Retrieve a player by their unique Player ID.
     If the player is not found, a 404 error is raised.
@@ -94,27 +178,29 @@ def read_player(player_id: int,
           description="Retrieve a list of all performances from the database.",
           response_description="A list of performance objects representing individual player performances.",
           operation_id="get_all_performances")
-def read_performances(skip: int = Query(0, description="The number of items to skip at the beginning of API call."),
-                      limit: int = Query(100, description="The number of records to return after the skipped records."),
-                      min_last_changed_date: date = Query(None, description="The minimum date of change that you want to return records."),
-                      db: Session = Depends(get_db)):
+@cache.streamed_response(schemas.PERFORMANCE_LIST_ADAPTER, expire=30)
+def read_performances(session_factory: Annotated[sessionmaker, Depends(get_session_factory)],
+                      skip: Annotated[int, Query(description="The number of items to skip at the beginning of API call.")] = 0,
+                      limit: Annotated[int, Query(description="The number of records to return after the skipped records.")] = 100,
+                      min_last_changed_date: Annotated[date | None, Query(description="The minimum date of change that you want to return records.")] = None):
     """
     Retrieve all performances within the specified range of records.
     Filters can be applied for performances updated after a given date.
+    The results are streamed in batches as they are read.
     """
-    performances = crud.get_performances(db,
-                                         skip=skip,
-                                         limit=limit,
-                                         min_last_changed_date=min_last_changed_date)
-    return performances
+    return iter_with_db(session_factory, crud.iter_performances,
+                        skip=skip,
+                        limit=limit,
+                        min_last_changed_date=min_last_changed_date)
 
 @app.get("/v0/leagues/{league_id}", response_model=schemas.League, tags=["membership"],
           summary="Get League by ID",
           description="Retrieve a specific league by its ID.",
           response_description="The details of a league with the given ID.",
           operation_id="get_league_by_id")
+@cache.cached_response(schemas.LEAGUE_ADAPTER, expire=30)
 def read_league(league_id: int,
-                db: Session = Depends(get_db)):
+                db: Annotated[Session, Depends(get_db)]):
     """
     Fetch league details by its ID.
     If no league is found, a 404 error is returned.
@@ -129,11 +215,12 @@ def read_league(league_id: int,
           description="Retrieve a list of all leagues from the database.",
           response_description="A list of league objects representing different leagues.",
           operation_id="get_all_leagues")
-def read_leagues(skip: int = Query(0, description="The number of items to skip at the beginning of API call."),
-                 limit: int = Query(100, description="The number of records to return after the skipped records."),
-                 min_last_changed_date: date = Query(None, description="The minimum date of change to filter records."),
-                 league_name: str = Query(None, description="The league name to filter records."),
-                 db: Session = Depends(get_db)):
+@cache.cached_response(schemas.LEAGUE_LIST_ADAPTER, expire=30)
+def read_leagues(db: Annotated[Session, Depends(get_db)],
+                 skip: Annotated[int, Query(description="The number of items to skip at the beginning of API call.")] = 0,
+                 limit: Annotated[int, Query(description="The number of records to return after the skipped records.")] = 100,
+                 min_last_changed_date: Annotated[date | None, Query(description="The minimum date of change to filter records.")] = None,
+                 league_name: Annotated[str | None, Query(description="The league name to filter records.")] = None):
     """
     Retrieve a list of all leagues from the database.
     Optionally, you can filter leagues by their name or the minimum change date.
@@ -150,12 +237,13 @@ def read_leagues(skip: int = Query(0, description="The number of items to skip a
           description="Retrieve a list of all teams in the system.",
           response_description="A list of team objects representing different teams.",
           operation_id="get_all_teams")
-def read_teams(skip: int = Query(0, description="The number of items to skip at the beginning of API call."),
-               limit: int = Query(100, description="The number of records to return after the skipped records."),
-               min_last_changed_date: date = Query(None, description="The minimum date of change to filter records."),
-               team_name: str = Query(None, description="The team name to filter records."),
-               league_id: int = Query(None, description="The league ID to filter teams."),
-               db: Session = Depends(get_db)):
+@cache.cached_response(schemas.TEAM_LIST_ADAPTER, expire=30)
+def read_teams(db: Annotated[Session, Depends(get_db)],
+               skip: Annotated[int, Query(description="The number of items to skip at the beginning of API call.")] = 0,
+               limit: Annotated[int, Query(description="The number of records to return after the skipped records.")] = 100,
+               min_last_changed_date: Annotated[date | None, Query(description="The minimum date of change to filter records.")] = None,
+               team_name: Annotated[str | None, Query(description="The team name to filter records.")] = None,
+               league_id: Annotated[int | None, Query(description="The league ID to filter teams.")] = None):
     """
     Retrieve a list of teams in the system.
     Filters can be applied for team names, league ID, or the minimum change date.
@@ -173,14 +261,33 @@ def read_teams(skip: int = Query(0, description="The number of items to skip at
           description="Retrieve the count of players, teams, and leagues in the system.",
           response_description="Returns a count of players, teams, and leagues.",
           operation_id="get_system_counts")
-def get_count(db: Session = Depends(get_db)):
+@cache.cached_response(schemas.COUNTS_ADAPTER, expire=300)
+def get_count(db: Annotated[Session, Depends(get_db)]):
     """
     Fetch the counts for players, teams, and leagues from the database.
     Returns the total number of players, teams, and leagues.
     """
+    league_count, team_count, player_count = crud.get_all_counts(db)
     counts = schemas.Counts(
-        league_count=crud.get_league_count(db),
-        team_count=crud.get_team_count(db),
-        player_count=crud.get_player_count(db)
+        league_count=league_count,
+        team_count=team_count,
+        player_count=player_count
     )
-    return counts
\ No newline at end of file
+    return counts
+
+
+# Dependency that only lets through callers holding the admin token
+def require_admin(x_admin_token: Annotated[str | None, Header()] = None):
+    if (not ADMIN_TOKEN or x_admin_token is None
+            or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN)):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+@app.post("/cache/invalidate", include_in_schema=False,
+          dependencies=[Depends(require_admin)],
+          summary="Invalidate Response Cache",
+          description="Drop all cached responses so the next calls read fresh data from the database.",
+          response_description="Confirms the cache was cleared.",
+          operation_id="invalidate_cache")
+def invalidate_cache():
+    cache.clear()
+    return {"message": "Cache cleared"}
@@ -1,5 +1,5 @@
 """SQLAlchemy models"""
-from sqlalchemy import Column, ForeignKey, Integer, String, Float, Date
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, Float, Date
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -7,6 +7,11 @@ from database import Base
 
 class Player(Base):
     __tablename__ = "player"
+    __table_args__ = (
+        # name lookups; last_changed_date isn't indexed because every
+        # player currently shares one value, so the planner would scan anyway
+        Index("idx_player_lastname_firstname", "last_name", "first_name"),
+    )
 
     player_id = Column(Integer, primary_key=True, index=True)
     gsis_id = Column(String, nullable=True)
@@ -25,6 +30,9 @@ class Player(Base):
 
 class Performance(Base):
     __tablename__ = "performance"
+    __table_args__ = (
+        Index("idx_perf_changed", "last_changed_date"),
+    )
 
     performance_id = Column(Integer, primary_key=True, index=True)
     week_number = Column(String, nullable=False)
@@ -49,6 +57,9 @@ class League(Base):
 
 class Team(Base):
     __tablename__ = "team"
+    __table_args__ = (
+        Index("idx_team_league_name", "league_id", "team_name"),
+    )
 
     team_id = Column(Integer, primary_key=True, index=True)
     team_name = Column(String, nullable=False)
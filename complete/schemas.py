@@ -1,4 +1,4 @@
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 from typing import List
 from datetime import date
 
@@ -46,4 +46,15 @@ class League(BaseModel):
 class Counts(BaseModel):
     league_count : int
     team_count : int
-    player_count : int
\ No newline at end of file
+    player_count : int
+
+
+# adapters built once at import and reused to validate and dump whole
+# responses in a single call instead of one model at a time
+PLAYER_ADAPTER = TypeAdapter(Player)
+PLAYER_LIST_ADAPTER = TypeAdapter(List[Player])
+PERFORMANCE_LIST_ADAPTER = TypeAdapter(List[Performance])
+LEAGUE_ADAPTER = TypeAdapter(League)
+LEAGUE_LIST_ADAPTER = TypeAdapter(List[League])
+TEAM_LIST_ADAPTER = TypeAdapter(List[Team])
+COUNTS_ADAPTER = TypeAdapter(Counts)
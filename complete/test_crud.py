@@ -1,7 +1,11 @@
 """Testing SQLAlchemy Helper Functions"""
 import pytest
 from datetime import date
+from types import SimpleNamespace
+from sqlalchemy import text
+from sqlalchemy.exc import InvalidRequestError
 
+import cache
 import crud
 from database import SessionLocal
 
@@ -32,6 +36,26 @@ def test_get_players_by_name(db_session):
     assert len(players) == 1
     assert players[0].player_id == 2009
 
+def test_player_name_lookup_uses_index(db_session):
+    """Tests that SQLite searches players by name through the index"""
+    plan = db_session.execute(text(
+        "EXPLAIN QUERY PLAN SELECT * FROM player "
+        "WHERE last_name = 'Young' AND first_name = 'Bryce'")).all()
+    assert "idx_player_lastname_firstname" in plan[0][-1]
+
+def test_performance_date_filter_uses_index(db_session):
+    """Tests that SQLite picks the date index for incremental sync queries"""
+    plan = db_session.execute(text(
+        "EXPLAIN QUERY PLAN SELECT * FROM performance "
+        "WHERE last_changed_date >= '2024-04-01'")).all()
+    assert "idx_perf_changed" in plan[0][-1]
+
+def test_get_players_raises_on_lazy_load(db_session):
+    """Tests that relationships the schema doesn't use are never lazy loaded"""
+    players = crud.get_players(db_session, first_name="Bryce", last_name="Young")
+    with pytest.raises(InvalidRequestError):
+        players[0].teams
+
 
 def test_get_all_performances(db_session):
     """Tests that the count of performances in the database is 
@@ -59,6 +83,13 @@ def test_get_leagues(db_session):
     leagues = crud.get_leagues(db_session, skip=0, limit=10000, min_last_changed_date=test_date)
     assert len(leagues) == 5
 
+def test_get_leagues_query_count(db_session, captured_statements):
+    """Tests that leagues, teams, players and performances are loaded
+    with one query each"""
+    leagues = crud.get_leagues(db_session, skip=0, limit=10000)
+    assert sum(len(league.teams) for league in leagues) == 20
+    assert len(captured_statements) == 4
+
 
 def test_get_teams(db_session):
     """Tests that the count of teams in the database is what is expected"""
@@ -71,6 +102,13 @@ def test_get_teams_for_one_league(db_session):
     assert len(teams) == 12
     assert teams[0].league_id == 5001
 
+def test_get_teams_paging(db_session):
+    """Tests that skip and limit page through the same filtered statement"""
+    first_page = crud.get_teams(db_session, skip=0, limit=5, league_id=5001)
+    second_page = crud.get_teams(db_session, skip=5, limit=5, league_id=5001)
+    assert len(first_page) == len(second_page) == 5
+    assert first_page[-1].team_id != second_page[0].team_id
+
 def test_get_team_players(db_session):
     """Tests that a team record can retrieve players, and that 8 players are on the first team"""
     first_team = crud.get_teams(db_session, skip=0, limit=1000, min_last_changed_date=test_date)[0]
@@ -87,4 +125,35 @@ def test_get_team_count(db_session):
 
 def test_get_league_count(db_session):
     league_count = crud.get_league_count(db_session)
-    assert league_count == 5
\ No newline at end of file
+    assert league_count == 5
+
+def test_counts_are_cached_until_expiry(db_session, captured_statements, monkeypatch):
+    """Tests a count is read once per TTL and recomputed after it expires"""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(cache, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    cache.clear()
+    assert crud.get_player_count(db_session) == 1018
+    assert len(captured_statements) == 1
+    clock.now += crud.COUNT_TTL_SECONDS - 1
+    assert crud.get_player_count(db_session) == 1018
+    assert len(captured_statements) == 1
+    clock.now += 2
+    assert crud.get_player_count(db_session) == 1018
+    assert len(captured_statements) == 2
+
+def test_get_all_counts(db_session):
+    league_count, team_count, player_count = crud.get_all_counts(db_session)
+    assert (league_count, team_count, player_count) == (5, 20, 1018)
+
+def test_iter_performances(db_session):
+    """Tests that streamed performances come back in batches covering every row"""
+    batches = list(crud.iter_performances(db_session, skip=0, limit=18000))
+    assert max(len(batch) for batch in batches) == crud.STREAM_BATCH_SIZE
+    assert sum(len(batch) for batch in batches) == 17306
+
+def test_get_player_uses_identity_map(db_session, captured_statements):
+    """Tests that a player already in the session is returned without a query"""
+    player = crud.get_player(db_session, player_id=1001)
+    captured_statements.clear()
+    assert crud.get_player(db_session, player_id=1001) is player
+    assert captured_statements == []
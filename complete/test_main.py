@@ -1,4 +1,15 @@
+import importlib.util
+
+import pytest
 from fastapi.testclient import TestClient
+from loguru import logger
+from sqlalchemy import event
+
+import cache
+import crud
+import main
+import models
+from database import engine
 from main import app
 
 client = TestClient(app)
@@ -72,3 +83,120 @@ def test_counts():
     assert response_data["league_count"] == 5
     assert response_data["team_count"] == 20
     assert response_data["player_count"] == 1018
+
+# test repeated calls are served from the cache without querying the database
+def test_cached_response(captured_statements):
+    cache.clear()
+    first = client.get("/v0/players/?first_name=Bryce&last_name=Young")
+    assert captured_statements
+    captured_statements.clear()
+    second = client.get("/v0/players/?first_name=Bryce&last_name=Young")
+    assert second.status_code == 200
+    assert second.content == first.content
+    assert captured_statements == []
+
+# test the cache refuses to be cleared without the admin token
+def test_invalidate_cache_requires_token(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    assert client.post("/cache/invalidate").status_code == 403
+    response = client.post("/cache/invalidate", headers={"X-Admin-Token": "wrong"})
+    assert response.status_code == 403
+    monkeypatch.setattr(main, "ADMIN_TOKEN", None)
+    response = client.post("/cache/invalidate", headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 403
+
+# test the cache can be cleared by an admin
+def test_invalidate_cache(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    client.get("/v0/teams/?league_id=5001")
+    assert cache._response_cache
+    response = client.post("/cache/invalidate", headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200
+    assert response.json() == {"message": "Cache cleared"}
+    assert not cache._response_cache
+
+# test the cache drops the least recently used responses once it's full
+def test_response_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(cache, "RESPONSE_CACHE_MAXSIZE", 3)
+    cache.clear()
+    for skip in range(5):
+        client.get(f"/v0/teams/?skip={skip}&limit=1")
+    assert len(cache._response_cache) == 3
+    assert [dict(key[1:])["skip"] for key in cache._response_cache] == [2, 3, 4]
+
+# test a streamed body too large for the cache is sent but not kept
+def test_large_streamed_response_is_not_cached():
+    cache.clear()
+    response = client.get("/v0/performances/?skip=0&limit=20000")
+    assert len(response.json()) == 17306
+    assert not cache._response_cache
+    response = client.get("/v0/performances/?skip=0&limit=10")
+    assert len(response.json()) == 10
+    assert len(cache._response_cache) == 1
+
+# test overriding the session factory reaches the streamed endpoints too
+def test_session_factory_override():
+    opened = []
+    def tracking_factory():
+        opened.append(True)
+        return main.ReadSession()
+    app.dependency_overrides[main.get_session_factory] = lambda: tracking_factory
+    try:
+        cache.clear()
+        client.get("/v0/players/?limit=1")
+        client.get("/v0/teams/?limit=1")
+    finally:
+        app.dependency_overrides.clear()
+    assert len(opened) == 2
+
+# test the app starts up and shuts down cleanly
+def test_lifespan():
+    with TestClient(app) as lifespan_client:
+        response = lifespan_client.get("/")
+        assert response.status_code == 200
+
+# test every pooled connection gets the WAL and memory-mapped I/O settings
+def test_sqlite_pragmas():
+    with engine.connect() as connection:
+        def pragma(name):
+            return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+        assert pragma("journal_mode") == "wal"
+        assert pragma("synchronous") == 1  # NORMAL
+        assert pragma("mmap_size") == 268435456
+        assert pragma("cache_size") == -64000
+        assert pragma("temp_store") == 2  # MEMORY
+        assert pragma("foreign_keys") == 1
+
+@pytest.fixture
+def debug_client(monkeypatch):
+    """A client for a fresh copy of the app loaded with DEBUG=1, plus the
+    query count warnings it logs"""
+    monkeypatch.setenv("DEBUG", "1")
+    spec = importlib.util.spec_from_file_location("main_debug", main.__file__)
+    debug_main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(debug_main)
+    warnings = []
+    sink_id = logger.add(warnings.append, level="WARNING", format="{message}")
+    cache.clear()
+    yield TestClient(debug_main.app), warnings
+    logger.remove(sink_id)
+    event.remove(engine, "before_cursor_execute", debug_main.count_query)
+    cache.clear()
+
+# test the debug query counter flags an N+1 and stays quiet otherwise
+def test_query_count_warning(debug_client, monkeypatch):
+    debug_app, warnings = debug_client
+    # load teams without eager loading so serializing them lazy loads
+    # every team's players and every player's performances
+    monkeypatch.setattr(crud, "get_teams",
+                        lambda db, limit, **filters: db.query(models.Team).limit(limit).all())
+    assert debug_app.get("/v0/teams/?limit=3").status_code == 200
+    assert len(warnings) == 1
+    assert "/v0/teams" in warnings[0]
+
+def test_query_count_quiet(debug_client):
+    debug_app, warnings = debug_client
+    assert debug_app.get("/v0/counts/").status_code == 200
+    # one selectin query per streamed batch stays under the scaled threshold
+    assert len(debug_app.get("/v0/players/?limit=1000").json()) == 1000
+    assert warnings == []